@@ -1,9 +1,33 @@
+import re
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, PasswordField, EmailField
-from wtforms.validators import DataRequired, URL, Length
+from wtforms.validators import DataRequired, URL, Length, ValidationError
 from flask_ckeditor import CKEditorField
 
 pass_message = "Password must be at least 8 characters long."
+register_pass_message = "Password must be between 8 and 128 characters long."
+email_message = "Please enter a valid email address."
+signup_label = 'SIGN ME UP!'
+login_label = 'LET ME IN!'
+
+# Compiled once at import; one match covers the shape and length checks
+_EMAIL_RE = re.compile(r'^[^@\s]{1,64}@[^@\s]{1,255}\.[^@\s]{2,}$')
+
+
+# Single-pass replacements for Email()/Length() chains, only applied when signing up
+# so accounts created before these rules can still log in
+def valid_email(form, field):
+    if not _EMAIL_RE.match(field.data.strip()):
+        raise ValidationError(email_message)
+
+
+def valid_password(form, field):
+    if not 8 <= len(field.data) <= 128:
+        raise ValidationError(register_pass_message)
+
+
+# Keep rendering minlength="8" on the input, as Length(min=8) did
+valid_password.field_flags = {'minlength': 8}
 
 
 # WTForm for creating a blog post
@@ -16,16 +40,16 @@ class CreatePostForm(FlaskForm):
 
 
 class RegisterForm(FlaskForm):
-    email = EmailField('Email', validators=[DataRequired()])
-    password = PasswordField('Password', validators=[DataRequired(), Length(min=8, message=pass_message)])
+    email = EmailField('Email', validators=[DataRequired(), valid_email])
+    password = PasswordField('Password', validators=[DataRequired(), valid_password])
     name = StringField('Name', validators=[DataRequired()])
-    submit = SubmitField('Sign me up!'.upper())
+    submit = SubmitField(signup_label)
 
 
 class LoginForm(FlaskForm):
     email = EmailField('Email', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired(), Length(min=8, message=pass_message)])
-    submit = SubmitField('Let me in!'.upper())
+    submit = SubmitField(login_label)
 
 
 class CommentForm(FlaskForm):
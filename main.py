@@ -1,32 +1,98 @@
+from base64 import b64decode
 from datetime import date
+import hashlib
+import hmac
 import os
-from flask import Flask, abort, render_template, redirect, url_for, flash
+import sqlite3
+import click
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from flask import Flask, abort, render_template, redirect, url_for, flash, request
 from flask_bootstrap import Bootstrap5
+from flask_caching import Cache
 from flask_ckeditor import CKEditor
 from flask_gravatar import Gravatar
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
 from functools import wraps
-from sqlalchemy import ForeignKey, Integer, Text
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import relationship, Mapped, mapped_column
+from sqlalchemy import ForeignKey, Integer, Text, bindparam, event, inspect, lambda_stmt, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+from sqlalchemy.orm import relationship, Mapped, mapped_column, selectinload, validates
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
 
 app = Flask(__name__)
+# Keep compiled templates around across requests and worker restarts;
+# must be set before anything touches app.jinja_env. Without JINJA_CACHE_DIR,
+# Jinja uses its own per-user 0700 cache directory.
+app.jinja_options = {
+    **app.jinja_options,
+    'bytecode_cache': FileSystemBytecodeCache(directory=os.environ.get('JINJA_CACHE_DIR')),
+    'auto_reload': app.debug,
+}
 app.config['SECRET_KEY'] = os.environ.get('APP_SECRET_KEY')
 ckeditor = CKEditor(app)
 Bootstrap5(app)
 
+# Anonymous visitors all get the same HTML for the public pages, so serve it from cache
+cache = Cache(app, config={
+    'CACHE_TYPE': os.environ.get('CACHE_TYPE', 'SimpleCache'),
+    'CACHE_DEFAULT_TIMEOUT': 60,
+})
+CACHED_ENDPOINTS = {'get_all_posts', 'about', 'contact'}
+
+
+def is_logged_in():
+    return current_user.is_authenticated
+
+
+# Heroku's router sits in front of gunicorn; trust its X-Forwarded-For hop so
+# request.remote_addr (and with it the rate limit key) is the real client
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get('PROXY_FIX_X_FOR', 1)))
+
+# Throttle credential checks so bots can't burn CPU on password hashing
+limiter = Limiter(get_remote_address,
+                  app=app,
+                  storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'memory://'))
+
 # Configure Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 # CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_URI', 'sqlite:///posts.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+# In-memory SQLite gets a StaticPool, which rejects the pool sizing arguments
+if db_uri != 'sqlite://' and ':memory:' not in db_uri and 'mode=memory' not in db_uri:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=10, max_overflow=20)
+if db_uri.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'check_same_thread': False}
 db = SQLAlchemy()
 db.init_app(app)
+POSTS_PER_PAGE = 20
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # Only tune SQLite connections, Postgres (DB_URI in production) manages this itself
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 
-# For adding profile images to the comment section
+# For adding profile images to the comment section (fallback for users without a stored email_md5)
 gravatar = Gravatar(app,
                     size=100,
                     rating='g',
@@ -37,9 +103,15 @@ gravatar = Gravatar(app,
                     base_url=None)
 
 
+def gravatar_hash(email):
+    return hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+
 # CONFIGURE TABLES
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
+    # Plain INTEGER PRIMARY KEY aliases SQLite's rowid, no sqlite_sequence bookkeeping on insert
+    __table_args__ = {'sqlite_autoincrement': False}
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
@@ -57,12 +129,22 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String, unique=True, nullable=False)
     password = db.Column(db.String, nullable=False)
     name = db.Column(db.String(150), nullable=False)
+    # Gravatar hash of the email, kept in sync on write so templates don't hash per render
+    email_md5 = db.Column(db.String(32))
     posts = relationship("BlogPost", back_populates="author")
     comments = relationship("Comment", back_populates='author')
+    __table_args__ = (db.Index('ix_users_email_lower', db.func.lower(email)),
+                      {'sqlite_autoincrement': False})
+
+    @validates('email')
+    def update_email_md5(self, key, email):
+        self.email_md5 = gravatar_hash(email)
+        return email
 
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = {'sqlite_autoincrement': False}
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
     author_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.id'))
@@ -71,14 +153,83 @@ class Comment(db.Model):
     blog = relationship("BlogPost", back_populates='comments')
 
 
-with app.app_context():
+# create_all() only creates missing tables, so changes to existing ones are applied here
+def add_email_md5_column():
+    columns = {column['name'] for column in inspect(db.engine).get_columns('users')}
+    if 'email_md5' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE users ADD COLUMN email_md5 VARCHAR(32)'))
+        click.echo('Added users.email_md5.')
+
+    # Rows written before the column existed never went through the email validator
+    users = db.session.execute(db.select(User).where(User.email_md5.is_(None))).scalars().all()
+    for user in users:
+        user.email_md5 = gravatar_hash(user.email)
+    db.session.commit()
+    if users:
+        click.echo(f'Backfilled email_md5 for {len(users)} users.')
+
+
+def add_email_lower_index():
+    # Logins match on lower(email); accounts that only differ by case can't all be reached
+    email_lower = db.func.lower(User.email)
+    collisions = db.session.execute(
+        db.select(email_lower, db.func.count()).group_by(email_lower).having(db.func.count() > 1)
+    ).all()
+    for email, count in collisions:
+        click.echo(f'Warning: {count} accounts use {email} with different case, '
+                   f'only one of them can log in. Merge or rename them.', err=True)
+
+    # SQLite can't reflect expression indexes, so checkfirst=True would miss it and fail on re-runs
+    index = next(index for index in User.__table__.indexes if index.name == 'ix_users_email_lower')
+    with db.engine.begin() as connection:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def check_schema():
+    # Fail the release step if a model column still has no counterpart in the database
+    inspector = inspect(db.engine)
+    missing = [f'{table.name}.{column.name}'
+               for table in db.metadata.sorted_tables
+               for column in table.columns
+               if column.name not in {c['name'] for c in inspector.get_columns(table.name)}]
+    if missing:
+        raise click.ClickException(f'Database is missing columns: {", ".join(missing)}. '
+                                   f'Add an upgrade step to init-db for them.')
+
+
+@app.cli.command('init-db')
+def init_db():
+    """Create the database tables and upgrade existing ones."""
     db.create_all()
+    add_email_md5_column()
+    add_email_lower_index()
+    check_schema()
+    click.echo('Initialized the database.')
+
+
+# Hot statements built once so their compiled SQL is reused across requests
+user_by_email_stmt = lambda_stmt(
+    lambda: db.select(User).where(db.func.lower(User.email) == bindparam('email')))
+user_id_by_email_stmt = lambda_stmt(
+    lambda: db.select(User.id).where(db.func.lower(User.email) == bindparam('email')))
+
+
+ADMIN_IDS = frozenset(int(x) for x in os.environ.get('ADMIN_IDS', '1').split(',') if x.strip())
+
+
+def is_admin():
+    # Resolving current_user runs load_user, but Flask-Login caches the result for the request
+    return int(current_user.get_id() or 0) in ADMIN_IDS
+
+
+app.jinja_env.globals['is_admin'] = is_admin
 
 
 def admin_only(function):
     @wraps(function)
     def decorated_function(*args, **kwargs):
-        if current_user.id != 1:
+        if not is_admin():
             return abort(403)
 
         return function(*args, **kwargs)
@@ -86,23 +237,60 @@ def admin_only(function):
     return decorated_function
 
 
+password_hasher = PasswordHasher(time_cost=3, memory_cost=64 * 1024, parallelism=2)
+
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+
+def verify_password(stored_hash, password):
+    if stored_hash.startswith('$argon2'):
+        try:
+            return password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    # Older accounts still carry hashlib PBKDF2 or Werkzeug's "pbkdf2:sha256:..." hashes
+    if not stored_hash.startswith('pbkdf2_sha256$'):
+        return check_password_hash(stored_hash, password)
+
+    _, iterations, salt, expected = stored_hash.split('$')
+    dk = hashlib.pbkdf2_hmac('sha256', password.encode(), b64decode(salt), int(iterations))
+    return hmac.compare_digest(dk, b64decode(expected))
+
+
+def password_needs_rehash(stored_hash):
+    return not stored_hash.startswith('$argon2') or password_hasher.check_needs_rehash(stored_hash)
+
+
+@app.after_request
+def add_etag(response):
+    # Let browsers revalidate the public pages with If-None-Match instead of re-downloading them
+    if request.endpoint in CACHED_ENDPOINTS and request.method == 'GET' and response.status_code == 200:
+        response.add_etag()
+        return response.make_conditional(request)
+    return response
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    return db.session.get(User, int(user_id))
 
 
 @app.route('/register', methods=['POST', 'GET'])
+@limiter.limit("5/minute", methods=['POST'])
 def register():
     register_form = RegisterForm()
     if register_form.validate_on_submit():
-        email = register_form.email.data
-        user = db.session.execute(db.select(User).where(User.email == email)).scalar()
+        email = register_form.email.data.strip().lower()
+        user_id = db.session.execute(user_id_by_email_stmt, {'email': email}).scalar()
 
-        if user:
+        if user_id:
             flash('You\'ve already signed up with that email, log in instead!')
             return redirect(url_for('login'))
 
-        hashed_pass = generate_password_hash(register_form.password.data, method='pbkdf2:sha256', salt_length=8)
+        hashed_pass = hash_password(register_form.password.data)
         new_user = User(
             email=email,  # type: ignore
             password=hashed_pass,  # type: ignore
@@ -117,17 +305,22 @@ def register():
 
 
 @app.route('/login', methods=['POST', 'GET'])
+@limiter.limit("5/minute", methods=['POST'])
 def login():
     login_form = LoginForm()
 
     if login_form.validate_on_submit():
-        email = login_form.email.data
-        user = db.session.execute(db.select(User).where(User.email == email)).scalar()
+        email = login_form.email.data.strip().lower()
+        user = db.session.execute(user_by_email_stmt, {'email': email}).scalar()
         if not user:
             flash('That email does not exist, please try again.')
-        elif not check_password_hash(user.password, login_form.password.data):
+        elif not verify_password(user.password, login_form.password.data):
             flash('Password incorrect, please try again.')
         else:
+            # Upgrade legacy or outdated hashes now that we have the plaintext
+            if password_needs_rehash(user.password):
+                user.password = hash_password(login_form.password.data)
+                db.session.commit()
             login_user(user)
             return redirect(url_for('get_all_posts'))
 
@@ -141,21 +334,32 @@ def logout():
 
 
 @app.route('/')
+@cache.cached(query_string=True, unless=is_logged_in)
 def get_all_posts():
-    posts = db.session.execute(db.select(BlogPost)).scalars().all()
-    return render_template("index.html", all_posts=posts)
+    # db.paginate reads ?page= from the request and only fetches one page of posts
+    pagination = db.paginate(
+        db.select(BlogPost).options(selectinload(BlogPost.author)).order_by(BlogPost.id.desc()),
+        per_page=POSTS_PER_PAGE)
+    return render_template("index.html", all_posts=pagination.items, pagination=pagination)
 
 
 @app.route("/post/<int:post_id>", methods=['POST', 'GET'])
 def show_post(post_id):
-    requested_post = db.get_or_404(BlogPost, post_id)
-    comment_form = CommentForm()
-    if comment_form.validate_on_submit():
+    requested_post = db.first_or_404(
+        db.select(BlogPost)
+        .where(BlogPost.id == post_id)
+        .options(selectinload(BlogPost.author),
+                 selectinload(BlogPost.comments).selectinload(Comment.author))
+    )
+    # Only logged-in users see (and can submit) the comment form, so skip building it for everyone else
+    comment_form = CommentForm() if current_user.is_authenticated else None
+    if comment_form and comment_form.validate_on_submit():
         new_comment = Comment(author_id=current_user.id,
                               blog_id=requested_post.id,
                               text=comment_form.comment_text.data)
         db.session.add(new_comment)
         db.session.commit()
+        return redirect(url_for('show_post', post_id=post_id))
 
     return render_template("post.html", post=requested_post, form=comment_form)
 
@@ -175,6 +379,7 @@ def add_new_post():
         )
         db.session.add(new_post)
         db.session.commit()
+        cache.clear()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form)
 
@@ -197,6 +402,7 @@ def edit_post(post_id):
         post.author = current_user
         post.body = edit_form.body.data
         db.session.commit()
+        cache.clear()
         return redirect(url_for("show_post", post_id=post.id))
     return render_template("make-post.html", form=edit_form, is_edit=True)
 
@@ -207,15 +413,18 @@ def delete_post(post_id):
     post_to_delete = db.get_or_404(BlogPost, post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.clear()
     return redirect(url_for('get_all_posts'))
 
 
 @app.route("/about")
+@cache.cached(unless=is_logged_in)
 def about():
     return render_template("about.html")
 
 
 @app.route("/contact")
+@cache.cached(unless=is_logged_in)
 def contact():
     return render_template("contact.html")
 